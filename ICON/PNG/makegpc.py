@@ -1,14 +1,27 @@
 #!/usr/bin/env python3
 import os
 import sys
+import struct
 import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+import numpy as np # Linux package python3-numpy; needs 1.15 or later for put_along_axis
 from PIL import Image # Linux package python-imaging may include python-pillow
+try:
+	from numba import njit
+	have_numba = True
+except ImportError:
+	# Numba is optional; without it the slower NumPy code paths are used.
+	have_numba = False
+	def njit(*args, **kwargs):
+		return lambda func: func
 
 parser = argparse.ArgumentParser(description="Converts a 16-color PNG to a Fairytale/Cocktail Soft GPC.")
 parser.add_argument("filename", help="PNG file to convert")
 parser.add_argument("-x", type=int, default=0, help="In-game X coordinate, default 0")
 parser.add_argument("-y", type=int, default=0, help="In-game Y coordinate, default 0")
-args = parser.parse_args()
+parser.add_argument("--fast", action="store_true", help="Only try the likeliest horizontal interlacing values on each row (faster, sometimes larger)")
 
 # The encoding process is:
 # - Ensure bitmap is padded to a 4-byte (8px) boundary
@@ -30,95 +43,198 @@ args = parser.parse_args()
 
 global hrz_steps
 #hrz_steps = [0, 1, 2, 4, 8, 0x10, 0x20, 0x26, 0x2A, 0x36, 0x38, 0x40, 0x49, 0x4D, 0x50]
-hrz_steps = range(0x51)
+hrz_steps = range(0x51) # must include 0
+# Tried first on every row, along with multiples of the plane width, which XOR each plane
+# with the one before it. The other values are only tried where they could do better, and
+# with --fast, only the hrz_near of them closest to the best value so far.
+hrz_fast = range(0x11)
+hrz_near = 4
 
+# GPC header layout, 0x64 bytes; the palette starts at 0x30 and the image header at 0x54.
+gpc_header = struct.Struct("<15sxIII20xHH32sHHH2xHHH2x")
+
+@lru_cache(maxsize=None)
 def MakeInterlaceTable(size, steps):
-	table = {}
+	# The result is cached, so steps has to be hashable (a range or tuple), and callers must
+	# not modify the returned arrays.
+	# Row [step] of the table is the scan order for that interlacing step, as indexes into a
+	# row (or column) of the given size. Rows for steps that weren't asked for are left at -1.
+	# Also returns the steps themselves as an int32 array, to select the valid rows.
+	table = np.full((max(steps) + 1, size), -1, dtype=np.int32)
 	for step in steps:
-		if step == 0: continue
-		result = [None] * size
-		start = 0
-		writeofs = 0
-		while start < step:
-			i = start
-			while i < size:
-				result[writeofs] = i
-				writeofs += 1
-				i += step
-			start += 1
-		table[step] = result
-	return table
-
-def VerticalIX(srcview, workview, w, h, vrt_list):
+		if step == 0:
+			# No interlacing, plain order.
+			table[0] = np.arange(size)
+			continue
+		# Every step'th index from 0, then every step'th from 1, and so on.
+		table[step] = np.concatenate([np.arange(start, size, step) for start in range(step)])
+	return table, np.array(steps, dtype=np.int32)
+
+def VerticalIX(srcarr, workarr, w, h, vrt_list):
 	stride = w >> 1
-	# Interlace row data from the split planes into workview (workbuf).
-	writeofs = 1
-	for row in vrt_list:
-		readofs = row * stride
-		workview[writeofs:writeofs + stride] = srcview[readofs:readofs + stride]
-		writeofs += stride + 1
-
-	if h == 1: return
-	# Xor every row but the topmost in workview (workbuf) with the row above it. (backward scan)
-	writeofs -= 1
-	for i in range((stride + 1) * (h - 1)):
-		writeofs -= 1
-		workview[writeofs] ^= workview[writeofs - stride - 1]
-
-def HorizontalIX(workview, rowbuf, w, h, hrz_lookup):
+	# Interlace row data from the split planes into workarr (workbuf), and in the same pass
+	# xor every row but the topmost with the source row that was placed above it.
+	rows = srcarr.reshape(h, stride)[vrt_list]
+	workrows = workarr.reshape(h, stride + 1)[:, 1:]
+	workrows[0] = rows[0]
+	np.bitwise_xor(rows[1:], rows[:-1], out=workrows[1:])
+
+# Inlined into the kernel, so it compiles the same as writing the loops out at each call;
+# as a plain call it's noticeably slower.
+@njit(cache=True)
+def _hrz_lower_bound(distinct, stride, nblocks):
+	# Fewest bits any non-zero hrz value could score on a row with this many distinct byte
+	# values, counting 00 even if absent. XOR'ing a scan of the row with the previous byte
+	# (starting from 00) has to change value at least distinct - 1 times, and the hrz byte
+	# itself is non-zero, so at least distinct bytes are non-zero and the rest could at best
+	# all fall in aligned 00 blocks.
+	return (distinct - min(nblocks, (stride + 1 - distinct) >> 3)) * 8
+
+@njit(cache=True, boundscheck=False, inline="always")
+def _score_row_numba(row, first, blocksend):
+	# Score without per-byte branches: 8 bits per non-zero byte, minus 8 for each aligned
+	# block of eight 00 bytes (a block is all 00 if OR'ing its bytes together gives 0).
+	nonzero = 0
+	for x in range(len(row)):
+		nonzero += row[x] != 0
+	saved = 0
+	for block in range(first, blocksend, 8):
+		acc = 0
+		for x in range(block, block + 8):
+			acc |= row[x]
+		saved += acc == 0
+	return (nonzero - saved) * 8
+
+@njit(cache=True, boundscheck=False, nogil=True)
+def _interlace_numba(srcarr, workarr, rowbuf, vrt_list, hrz_values, hrz_table, nfast, hrz_next, w, h):
+	# VerticalIX followed by HorizontalIX, but as plain loops for Numba to compile, and done a
+	# row at a time so that each row is still in cache while its candidates are made.
 	stride = w >> 1
+	ntries = nfast + hrz_next.shape[1]
+	seen = np.zeros(256, np.bool_)
+	# hrz 0 is a plain copy of the row, so interlace each row straight into its candidate.
+	plain = rowbuf[0]
+	aboveofs = 0
 	rowstart = 1
-	# Whether scanning forward or backward, it's a bit hard to handle flag A and flag B bytes,
-	# since they're out of sync with the scan pointer...
-	# Try to at least count 0 bytes sensibly.
 	for y in range(h):
-		# Generate copies of this row with each horizontal interlaced XOR value.
-		rowbuf[0][1:1 + stride] = workview[rowstart:rowstart + stride]
-		for hrz in hrz_steps:
-			if hrz == 0: continue
+		readofs = vrt_list[y] * stride
+		if y == 0:
+			for x in range(stride):
+				plain[x + 1] = srcarr[readofs + x]
+		else:
+			for x in range(stride):
+				plain[x + 1] = srcarr[readofs + x] ^ srcarr[aboveofs + x]
+		aboveofs = readofs
+
+		first = -rowstart & 7
+		nblocks = max(0, (stride + 1 - first) >> 3)
+		blocksend = first + nblocks * 8
+		bestbits = _score_row_numba(plain, first, blocksend)
+		best_idx = 0
+		near = hrz_next[0]
+
+		for i in range(1, ntries):
+			if i < nfast:
+				step = i
+			else:
+				if i == nfast:
+					# Only try the remaining steps if one of them could still beat the best so far.
+					seen[:] = False
+					seen[0] = True
+					distinct = 1
+					for x in range(1, stride + 1):
+						distinct += not seen[plain[x]]
+						seen[plain[x]] = True
+					if bestbits < _hrz_lower_bound(distinct, stride, nblocks):
+						break
+					near = hrz_next[best_idx]
+				step = near[i - nfast]
+			row = rowbuf[step]
+			hrz = hrz_values[step]
+			lookup = hrz_table[hrz]
 			lastbyte = 0
-			lookup = hrz_lookup[hrz]
 			for x in range(stride):
-				nextbyte = workview[rowstart + lookup[x]]
-				rowbuf[hrz][lookup[x] + 1] = lastbyte ^ nextbyte
+				nextbyte = plain[lookup[x] + 1]
+				row[lookup[x] + 1] = lastbyte ^ nextbyte
 				lastbyte = nextbyte
 
-		# Estimate how many bits each row would compress into.
-		bestbits = 0xFFFF
-		#print("===========")
-		for hrz in hrz_steps:
-			row = rowbuf[hrz]
-			#print(row.hex())
-			nullrun = 0
-			bits = 0
-			align = rowstart
-			for x in range(stride + 1):
-				if row[x] != 0:
-					bits += 8
-					nullrun = 0
-				else:
-					nullrun = (nullrun + 1) & 7
-					if nullrun == 0:
-						bits -= 8
-				align = (align + 1) & 7
-				if align == 0:
-					nullrun = 0
-			if bits < bestbits:
+			bits = _score_row_numba(row, first, blocksend)
+			# On a tie, the lowest hrz value wins, whatever order the steps were tried in.
+			if bits < bestbits or (bits == bestbits and hrz < hrz_values[best_idx]):
 				bestbits = bits
-				besthrz = hrz
+				best_idx = step
 
-		# Overwrite the current row in workview (workbuf) with the hopefully best XOR'ed row.
-		#print("row",y,"using hrz",besthrz)
-		workview[rowstart - 1:rowstart + stride] = rowbuf[besthrz]
+		for x in range(stride + 1):
+			workarr[rowstart - 1 + x] = rowbuf[best_idx, x]
 		rowstart += stride + 1
 
-def Encode(workview, finalview):
+def _hrz_candidates(row, cands, matrix):
+	# Fill in cands with this row XOR'ed in each scan order of matrix: XOR every byte in scan
+	# order with the previous one, then scatter the bytes back to their original positions.
+	permuted = row[matrix]
+	xored = permuted.copy()
+	xored[:, 1:] ^= permuted[:, :-1]
+	np.put_along_axis(cands[:, 1:], matrix, xored, axis=1)
+
+def _hrz_scores(cands, first, nblocks):
+	# Estimate how many bits each row would compress into: 8 per non-zero byte, minus 8
+	# for each aligned block of eight 00 bytes. Read each block as one 64-bit word, which is
+	# 0 if its bytes are all 00. The blocks need copying out first: before NumPy 1.23, only
+	# contiguous arrays can be viewed as a wider type.
+	blocks = np.ascontiguousarray(cands[:, first:first + nblocks * 8]).view(np.uint64)
+	return (np.count_nonzero(cands, axis=1) - np.count_nonzero(blocks == 0, axis=1)) * 8
+
+def _best_step(bits, hrz_values, steps):
+	# The step out of steps with the fewest bits. On a tie, the lowest hrz value wins, whatever
+	# order the steps were tried in.
+	steps = steps[bits[steps] == bits[steps].min()]
+	return steps[hrz_values[steps].argmin()]
+
+def HorizontalIX(workarr, rowbuf, w, h, hrz_values, hrz_table, nfast, hrz_next):
+	# rowbuf holds one candidate row per step, hrz_values[step] being its hrz value. Step 0
+	# is always hrz 0. The first nfast steps are always tried, then hrz_next[best] for the
+	# best of those, on rows where they might win.
+	stride = w >> 1
+	nsteps = len(hrz_values)
+	faststeps = np.arange(nfast)
+	hrz_matrix = hrz_table[hrz_values]
+	bits = np.empty(nsteps, dtype=np.int64)
+	rowstart = 1
+	# Whether scanning forward or backward, it's a bit hard to handle flag A and flag B bytes,
+	# since they're out of sync with the scan pointer...
+	# Try to at least count 0 bytes sensibly.
+	for y in range(h):
+		# Generate copies of this row with each horizontal interlaced XOR value, all at once.
+		row = workarr[rowstart:rowstart + stride]
+		first = -rowstart & 7
+		nblocks = max(0, (stride + 1 - first) >> 3)
+		rowbuf[0, 1:] = row # hrz 0 is a plain copy
+		_hrz_candidates(row, rowbuf[1:nfast], hrz_matrix[1:nfast])
+		bits[:nfast] = _hrz_scores(rowbuf[:nfast], first, nblocks)
+		tried = faststeps
+		distinct = np.count_nonzero(np.bincount(row)[1:]) + 1
+		if bits[:nfast].min() >= _hrz_lower_bound(distinct, stride, nblocks):
+			near = hrz_next[_best_step(bits, hrz_values, faststeps)]
+			# Indexing with near makes a copy, so fill that in and put it back.
+			cands = rowbuf[near]
+			_hrz_candidates(row, cands, hrz_matrix[near])
+			rowbuf[near] = cands
+			bits[near] = _hrz_scores(cands, first, nblocks)
+			tried = np.concatenate((faststeps, near))
+		best_idx = _best_step(bits, hrz_values, tried)
+
+		# Overwrite the current row in workarr (workbuf) with the hopefully best XOR'ed row.
+		workarr[rowstart - 1:rowstart + stride] = rowbuf[best_idx]
+		rowstart += stride + 1
+
+@njit(cache=True, boundscheck=False, nogil=True)
+def _encode_numba(workarr, finalarr):
 	# Work from end to beginning, since this allows building and writing the flag values in
 	# a single linear pass. Otherwise would have to keep poking flag values into the past...
 	flagA = 0
 	flagB = 0
-	readofs = len(workview)
-	writeofs = len(finalview)
+	readofs = len(workarr)
+	writeofs = len(finalarr)
 	# Since working from the end, the last section may not be a neat multiple of 8 or 64.
 	# This can be handled by initialising flag A and flag B as if there were extra 00 bytes
 	# until the next 64-byte boundary.
@@ -135,10 +251,10 @@ def Encode(workview, finalview):
 	while readofs != 0:
 		flagB >>= 1
 		readofs -= 1
-		if workview[readofs] != 0:
+		if workarr[readofs] != 0:
 			# Non-zero byte: output as literal, add a 1 bit in flag B.
 			writeofs -= 1
-			finalview[writeofs] = workview[readofs]
+			finalarr[writeofs] = workarr[readofs]
 			flagB |= 0x80
 		flagBbitsleft -= 1
 		if flagBbitsleft == 0:
@@ -147,129 +263,225 @@ def Encode(workview, finalview):
 			if flagB != 0:
 				# Some literals were present. Output flag B, add a 1 bit in flag A.
 				writeofs -= 1
-				finalview[writeofs] = flagB
+				finalarr[writeofs] = flagB
 				flagA |= 0x80
 			flagAbitsleft -= 1
 			if flagAbitsleft == 0:
 				flagAbitsleft = 8
 				writeofs -= 1
-				finalview[writeofs] = flagA
+				finalarr[writeofs] = flagA
 
 	return writeofs
 
-def Compress(srcbuf, w, h):
+def Encode(workarr, finalarr):
+	# Write the compressed data to the end of finalarr, and return where it starts.
+	if have_numba:
+		writeofs = _encode_numba(workarr, finalarr)
+	else:
+		# The same encoding, but built front to back with array operations. Padding to a whole
+		# number of 64-byte blocks with 00 bytes adds no literals, and the flag bits it adds are
+		# the same 0 bits the backward scan starts out with.
+		nblocks = (len(workarr) + 63) >> 6
+		padded = np.zeros(nblocks * 64, dtype=np.uint8)
+		padded[:len(workarr)] = workarr
+		groups = padded.reshape(nblocks, 8, 8)
+		flagB = np.packbits(groups != 0, axis=2)
+		flagA = np.packbits(flagB != 0, axis=1)
+		# Each block is flag A, followed by flag B and the bytes of each group of 8. Flag A is
+		# always written; flag B only if non-zero, and only the non-zero bytes as literals.
+		stream = np.concatenate((flagA.reshape(nblocks, 1), np.concatenate((flagB, groups), axis=2).reshape(nblocks, 72)), axis=1)
+		keep = stream != 0
+		keep[:, 0] = True
+		out = stream[keep]
+		writeofs = len(finalarr) - len(out)
+		if writeofs >= 0:
+			finalarr[writeofs:] = out
+	if writeofs < 0:
+		# finalarr was too small. Numba doesn't check bounds, so it will have wrapped around and
+		# overwritten the end of the output instead.
+		raise ValueError("Compressed data overflowed the output buffer")
+	return writeofs
+
+if have_numba:
+	# Pay the JIT compilation cost once at startup, with a dummy 1-byte-wide image. The source
+	# is read-only like the real one from np.frombuffer, or Numba would compile it all again.
+	_interlace_numba(np.frombuffer(bytes(1), np.uint8), np.zeros(2, np.uint8), np.zeros((1, 2), np.uint8),
+		np.zeros(1, np.int32), np.zeros(1, np.int32), np.zeros((1, 1), np.int32), 1, np.zeros((1, 0), np.int32), 2, 1)
+	_encode_numba(np.zeros(2, np.uint8), np.zeros(2, np.uint8))
+
+def _try_buffers(w, h, hrz_values):
+	# Buffers for one vrt try: candidate rows, work and output.
 	stride = w >> 1
-	hrz_lookup = MakeInterlaceTable(stride, hrz_steps)
-	vrt_lookup = MakeInterlaceTable(h, [1, 2, 4])
-	rowbuf = {}
-	for hrz in hrz_steps:
-		rowbuf[hrz] = bytearray(stride + 1)
-		rowbuf[hrz][0] = hrz
-	workbuf = bytearray((stride + 1) * h)
-	workview = memoryview(workbuf) # direct access to bytes to avoid copy on slice
-	srcview = memoryview(srcbuf)
-	finalbuf = bytearray(len(workview) * 8 // 7) # preallocate for worst-case output size
-	finalview = memoryview(finalbuf)
-	bestofs = 0
-	# Generate a compressed buffer for each vertical interlacing value, keep the smallest one.
-	for vrt in [2, 1, 4]:
-		print("... trying vrt",vrt,"...")
-		VerticalIX(srcview, workview, w, h, vrt_lookup[vrt])
-		HorizontalIX(workview, rowbuf, w, h, hrz_lookup)
-		writeofs = Encode(workview, finalview)
-		if writeofs > bestofs:
-			bestbuf = finalbuf[writeofs:]
-			bestofs = writeofs
-			bestvrt = vrt
-	return bestbuf, bestvrt
-
-if args.filename.lower().endswith('.gpc'):
-	print("Error: This tool converts PNG to GPC, not GPC to PNG.")
-	print("Please provide a PNG file as input.")
-	exit(1)
-
-with Image.open(args.filename) as img:
-	print("Read as", img.format, img.size, img.mode)
-	if img.mode != 'P':
-		print("Image must have a palette")
-		exit(2)
-	palette = img.getpalette()
-	if len(palette) < 48:
-		palette.extend(bytearray(48 - len(palette)))
-	elif len(palette) > 48:
-		palette = palette[0:48]
-
-	if (img.width > 640):
-		print("Image width should be no larger than 640 pixels")
-		exit(4)
-	if (img.height > 400):
-		print("Image height should be no larger than 400 pixels")
-		exit(4)
-	basename, ext = os.path.splitext(img.filename)
-
-	# Header
-	outbuf = bytearray("PC98)GPCFILE   ".encode()) # sig
-	outbuf += bytearray(5) # terminating null and vertical interlacing dword, tbd later
-	outbuf += bytearray([0x30, 0, 0, 0, 0x54, 0, 0, 0]) # palette and image pointers
-	outbuf += bytearray(20) # padding to start of palette
-
-	outbuf += bytearray([16, 0, 2, 0]) # palette dimensions
-	for i in range(0, 48, 3):
-		outbuf += bytearray([(palette[i] & 0xF0) | (palette[i + 2] >> 4), palette[i + 1] >> 4])
-
-	# Image dimensions.
-	w = img.width
-	h = img.height
-	outbuf += bytearray([w & 0xFF, w >> 8, h & 0xFF, h >> 8, 0, 0, 0, 0, 4, 0, args.x & 0xFF, args.x >> 8, args.y & 0xFF, args.y >> 8, 0, 0])
-
-	if (img.width % 8) != 0:
-		# Pad width to a multiple of 8 with transparent 0's.
-		newimg = Image.new(img.mode, ((img.width + 7) & 0xFFF8, img.height), 16)
-		newimg.paste(img, (0, 0))
-		img = newimg
-		w = img.width
-
-	# The bitmap is an array of individual 4/8 bpp pixel values in scanline order.
-	bitmap = img.getdata()
-
-	# Separate the bitplanes into four plane buffers, 8 1-bit pixels in each byte, and place
-	# the buffers side by side into a single bitmap.
-	planebuf = bytearray(len(bitmap) >> 1)
-	planewidth = w >> 3
-	ofs = 0
-	octet = [0] * 4
-	x = 0
-	for j in range(0, len(bitmap), 8):
-		for l in range(j, j + 8):
-			for i in range(4):
-				octet[i] = (octet[i] << 1) | ((bitmap[l] >> i) & 1)
-		o = ofs
+	rowbuf = np.empty((len(hrz_values), stride + 1), dtype=np.uint8)
+	rowbuf[:, 0] = hrz_values
+	# No need to clear these: every byte of workarr is written before it's read, and only the
+	# part of finalarr that Encode writes is kept.
+	workarr = np.empty((stride + 1) * h, dtype=np.uint8)
+	# Preallocate for the worst-case output size: every byte a literal, plus a flag B byte for
+	# every 8 bytes and a flag A byte for every 64, counting partial groups at the end.
+	n = len(workarr)
+	finalarr = np.empty(n + ((n + 7) >> 3) + ((n + 63) >> 6), dtype=np.uint8)
+	return rowbuf, workarr, finalarr
+
+# Set up by _init_worker in each worker process, when the tries run in processes: the
+# encoder's tables, and buffers for the one try the process runs at a time.
+_worker = None
+
+def _init_worker(tables):
+	global _worker
+	w, h, hrz_values = tables[:3]
+	_worker = tables, _try_buffers(w, h, hrz_values)
+
+def _try_vrt(srcbuf, vrt, vrt_list, tables=None, buffers=None):
+	# Compress the whole image with one vertical interlacing value. tables are as set up by
+	# GPCEncoder; without them, this is a worker process, so use its own.
+	print("... trying vrt",vrt,"...")
+	if tables is None:
+		tables, buffers = _worker
+	w, h, hrz_values, hrz_table, nfast, hrz_next = tables
+	rowbuf, workarr, finalarr = buffers
+	srcarr = np.frombuffer(srcbuf, dtype=np.uint8)
+	if have_numba:
+		_interlace_numba(srcarr, workarr, rowbuf, vrt_list, hrz_values, hrz_table, nfast, hrz_next, w, h)
+	else:
+		VerticalIX(srcarr, workarr, w, h, vrt_list)
+		HorizontalIX(workarr, rowbuf, w, h, hrz_values, hrz_table, nfast, hrz_next)
+	writeofs = Encode(workarr, finalarr)
+	return finalarr[writeofs:]
+
+class GPCEncoder:
+	# Compresses any number of w x h images, building the lookup tables, buffers and worker
+	# threads or processes once. close() it when done, or use it in a with statement.
+	# Every compress() call uses the same buffers, so calls from several threads take turns.
+	vrt_steps = [2, 1, 4]
+
+	def __init__(self, w, h, fast=False):
+		hrz_table, hrz_values = MakeInterlaceTable(w >> 1, hrz_steps)
+		# Order the steps as hrz 0, then the values to try on every row, then the rest.
+		planewidth = w >> 3
+		first = [*hrz_fast, planewidth, planewidth * 2, planewidth * 3]
+		rank = np.where(np.isin(hrz_values, first), 1, 2)
+		rank[hrz_values == 0] = 0
+		hrz_values = hrz_values[np.argsort(rank, kind="stable")]
+		nfast = np.count_nonzero(rank < 2)
+		# hrz_next[step] are the steps to try after the fast ones when step was the best of them:
+		# all the rest, or with fast, the few with the nearest hrz values.
+		distance = np.abs(hrz_values[:nfast, None] - hrz_values[None, nfast:])
+		nearest = np.argsort(distance, axis=1, kind="stable")
+		if fast:
+			nearest = nearest[:, :hrz_near]
+		hrz_next = (nfast + nearest).astype(np.int32)
+		tables = (w, h, hrz_values, hrz_table, nfast, hrz_next)
+		self.vrt_table, _ = MakeInterlaceTable(h, (1, 2, 4))
+		# The tries are independent, so run them all at once. The Numba functions release the
+		# GIL, so threads can share the work, though each try needs its own buffers. Otherwise
+		# it takes separate processes, which each get a copy of the tables and allocate their
+		# own buffers once, when they start.
+		workers = len(self.vrt_steps)
+		if have_numba:
+			self.pool = ThreadPoolExecutor(max_workers=workers)
+			self.try_args = [(tables, _try_buffers(w, h, hrz_values)) for vrt in self.vrt_steps]
+		else:
+			self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(tables,))
+			self.try_args = [()] * workers
+		self.lock = threading.Lock()
+
+	def close(self):
+		self.pool.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+	def compress(self, srcbuf):
+		# Generate a compressed buffer for each vertical interlacing value, keep the smallest.
+		# As bytes, the source is read-only, like the array the Numba functions were warmed up
+		# with; a writable one would have them compile all over again.
+		srcbuf = bytes(srcbuf)
+		with self.lock:
+			tries = [self.pool.submit(_try_vrt, srcbuf, vrt, self.vrt_table[vrt], *args)
+				for vrt, args in zip(self.vrt_steps, self.try_args)]
+			bestbuf = None
+			for vrt, attempt in zip(self.vrt_steps, tries):
+				finalbuf = attempt.result()
+				if bestbuf is None or len(finalbuf) < len(bestbuf):
+					bestbuf = finalbuf
+					bestvrt = vrt
+			return bestbuf.tobytes(), bestvrt
+
+def Compress(srcbuf, w, h, fast=False):
+	with GPCEncoder(w, h, fast) as encoder:
+		return encoder.compress(srcbuf)
+
+if __name__ == "__main__":
+	args = parser.parse_args()
+
+	if args.filename.lower().endswith('.gpc'):
+		print("Error: This tool converts PNG to GPC, not GPC to PNG.")
+		print("Please provide a PNG file as input.")
+		exit(1)
+
+	with Image.open(args.filename) as img:
+		print("Read as", img.format, img.size, img.mode)
+		if img.mode != 'P':
+			print("Image must have a palette")
+			exit(2)
+		palette = img.getpalette()
+		if len(palette) < 48:
+			palette.extend(bytearray(48 - len(palette)))
+		elif len(palette) > 48:
+			palette = palette[0:48]
+
+		if (img.width > 640):
+			print("Image width should be no larger than 640 pixels")
+			exit(4)
+		if (img.height > 400):
+			print("Image height should be no larger than 400 pixels")
+			exit(4)
+		basename, ext = os.path.splitext(img.filename)
+
+		# Image dimensions, as stored in the header.
+		imgwidth = w = img.width
+		imgheight = h = img.height
+
+		# The bitmap is an array of individual 4/8 bpp pixel values, one row per scanline.
+		pixels = np.asarray(img, dtype=np.uint8)
+
+		if (w % 8) != 0:
+			# Pad width to a multiple of 8 with transparent 0's.
+			pixels = np.pad(pixels, ((0, 0), (0, -w & 7)))
+			w = pixels.shape[1]
+
+		# Separate the bitplanes into four plane buffers, 8 1-bit pixels in each byte, and place
+		# the buffers side by side into a single bitmap.
+		# Bit i of every pixel goes into plane i, leftmost pixel in the top bit of each byte.
+		planewidth = w >> 3
+		planes = np.empty((h, 4, planewidth), dtype=np.uint8)
 		for i in range(4):
-			planebuf[o] = octet[i]
-			o += planewidth
-			octet[i] = 0
-		ofs += 1
-		x += 8
-		# Next row.
-		if x >= w:
-			x = 0
-			ofs += planewidth * 3
-
-	compressed_data, bestvrt = Compress(planebuf, w, h)
-	print("Using vertical interlacing " + str(bestvrt) + ", compressed to", len(compressed_data), "bytes + header.")
-
-	# Stash the vertical interlacing value in the header.
-	outbuf[0x10] = bestvrt & 0xFF
-	outbuf[0x11] = bestvrt >> 8
-	# Stash compressed size in the header.
-	outbuf[0x58] = len(compressed_data) & 0xFF
-	outbuf[0x59] = len(compressed_data) >> 8
-	# Stash the compressed bytes.
-	outbuf += compressed_data
-
-	outputname = basename + '.gpc'
-	print("writing into", outputname)
-	with open(outputname, 'wb') as f:
-		f.write(outbuf)
-
-exit(0)
+			planes[:, i, :] = np.packbits((pixels >> i) & 1, axis=1)
+		planebuf = planes.tobytes()
+
+		with GPCEncoder(w, h, args.fast) as encoder:
+			compressed_data, bestvrt = encoder.compress(planebuf)
+		print("Using vertical interlacing " + str(bestvrt) + ", compressed to", len(compressed_data), "bytes + header.")
+
+		# Palette: 12-bit RGB, two bytes per colour.
+		palbytes = bytes(byte for i in range(0, 48, 3)
+			for byte in ((palette[i] & 0xF0) | (palette[i + 2] >> 4), palette[i + 1] >> 4))
+		header = gpc_header.pack(
+			b"PC98)GPCFILE   ", # sig, followed by a terminating null
+			bestvrt, # vertical interlacing dword
+			0x30, 0x54, # palette and image pointers, then padding to start of palette
+			16, 2, palbytes, # palette dimensions and colours
+			imgwidth, imgheight, len(compressed_data), # image dimensions and compressed size
+			4, args.x, args.y) # always 4, then in-game coordinates
+		outbuf = header + compressed_data
+
+		outputname = basename + '.gpc'
+		print("writing into", outputname)
+		with open(outputname, 'wb') as f:
+			f.write(outbuf)
+
+	exit(0)